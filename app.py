@@ -3,23 +3,53 @@ LAN File-Sharing Platform - Flask Backend
 A lightweight, self-hosted file sharing solution for local networks.
 """
 
+import io
 import os
-import uuid
+import codecs
+import errno
+import atexit
+import secrets
 import json
 import shutil
 import socket
+import subprocess
+import tempfile
+import hashlib
+import time
+import heapq
+import threading
+import multiprocessing
 import mimetypes
-from datetime import datetime, timezone
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from functools import wraps
+from functools import lru_cache, wraps
+from operator import itemgetter
 from io import BytesIO
+from urllib.parse import quote
 import zipfile
 
 from flask import (
-    Flask, request, jsonify, send_file, render_template,
+    Flask, Request, request, jsonify, send_file, render_template,
     Response, stream_with_context
 )
+from flask.json.provider import DefaultJSONProvider
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import ClosingIterator
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
 
 try:
     from PIL import Image
@@ -27,114 +57,947 @@ try:
 except ImportError:
     PILLOW_AVAILABLE = False
 
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJPF_GRAY, TJSAMP_420, TJSAMP_GRAY
+    _TURBOJPEG = TurboJPEG()  # Raises if the libturbojpeg shared library is missing
+    TURBOJPEG_AVAILABLE = True
+except (ImportError, OSError, RuntimeError):
+    TURBOJPEG_AVAILABLE = False
+
+try:
+    import oxipng
+    OXIPNG_AVAILABLE = True
+except ImportError:
+    OXIPNG_AVAILABLE = False
+
+CJPEGLI = shutil.which('cjpegli')  # jpegli's encoder, used for the 'small' JPEG setting
+JPEGLI_AVAILABLE = CJPEGLI is not None
+
 try:
     from PyPDF2 import PdfReader, PdfWriter
     PYPDF2_AVAILABLE = True
 except ImportError:
     PYPDF2_AVAILABLE = False
 
+try:
+    import pikepdf
+    PIKEPDF_AVAILABLE = True
+except ImportError:
+    PIKEPDF_AVAILABLE = False
+
+PDF_COMPRESSION = PIKEPDF_AVAILABLE or PYPDF2_AVAILABLE
+
 # Initialize Flask app
 app = Flask(__name__)
 
 # Configuration
 UPLOAD_DIR = os.environ.get('UPLOAD_DIR', './uploads')
 MAX_FILE_SIZE = int(os.environ.get('MAX_FILE_SIZE', 536870912))  # 500MB default
-ALLOWED_EXTENSIONS = os.environ.get(
+ALLOWED_EXTENSIONS = frozenset(ext.strip().lower() for ext in os.environ.get(
     'ALLOWED_EXTENSIONS',
     'pdf,png,jpg,jpeg,gif,txt,md,json,csv,doc,docx,xlsx,xls,ppt,pptx,zip,tar,gz,mp3,mp4,wav,avi,mov'
-).split(',')
+).split(','))
 
-# Ensure upload directory exists
-Path(UPLOAD_DIR).mkdir(parents=True, exist_ok=True)
+# Let a reverse proxy send file bodies: X-Sendfile (Apache, lighttpd) or,
+# when X_ACCEL_PREFIX is set, nginx's X-Accel-Redirect to an internal location
+USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE', 'false').lower() == 'true'
+X_ACCEL_PREFIX = os.environ.get('X_ACCEL_PREFIX', '')
 
 # In-memory file metadata store (in production, use SQLite or similar)
 METADATA_FILE = os.path.join(UPLOAD_DIR, '.metadata.json')
+METADATA_JOURNAL = os.path.join(UPLOAD_DIR, '.metadata.journal')
+JOURNAL_COMPACT_ENTRIES = 1000  # Minimum journal length before it is folded into the snapshot
 SETTINGS_FILE = os.path.join(UPLOAD_DIR, '.settings.json')
 TRASH_FILE = os.path.join(UPLOAD_DIR, '.trash.json')
+TRASH_DIR = os.path.join(UPLOAD_DIR, '.trash')  # Deleted files wait here until purged
+ZIP_CACHE_DIR = os.path.join(UPLOAD_DIR, '.zipcache')  # Recently built batch download archives
+ZIP_CACHE_MAX_BYTES = int(os.environ.get('ZIP_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024))  # 0 disables the cache
+COMPRESS_CACHE_DIR = os.path.join(UPLOAD_DIR, '.compressed')  # Results of compressed downloads
+COMPRESS_CACHE_MAX_BYTES = int(os.environ.get('COMPRESS_CACHE_MAX_BYTES', 1024 * 1024 * 1024))  # 0 disables the cache
 TRASH_EXPIRY = 86400  # 24 hours in seconds
+TRASH_EXPIRY_DELTA = timedelta(seconds=TRASH_EXPIRY)
+METADATA_FLUSH_INTERVAL = float(os.environ.get('METADATA_FLUSH_INTERVAL', 0.2))  # Seconds
+ZIPINFO_HAS_LEVEL = hasattr(zipfile.ZipInfo, 'compress_level')  # Public per-entry level (Python 3.13+)
+ZIP_CHUNK_SIZE = 1024 * 1024  # Read size when streaming files into a ZIP
+STAGING_BUFFER_SIZE = 1024 * 1024  # Write size when staging uploaded file parts
+PREVIEW_LIMIT = 50000  # Bytes of a text file returned by the preview endpoint
+PREVIEW_MAX_AGE = 3600  # Seconds browsers may reuse an image/PDF preview without revalidating
+
+# Compressed downloads at or above these qualities send the original file:
+# PNG is lossless, a JPEG re-encoded at 95+ is within a few percent of its
+# source, and GIF re-saving only shaves off palette overhead.
+PASSTHROUGH_QUALITY = {'image/png': 90, 'image/jpeg': 95, 'image/jpg': 95, 'image/gif': 0}
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'  # Leading bytes of a zstd frame
+
+# MIME types matched by the `type` filter of the file listing
+LIST_TYPE_FILTERS = {
+    'images': frozenset({'image/png', 'image/jpeg', 'image/gif', 'image/webp'}),
+    'documents': frozenset({'application/pdf', 'application/msword',
+                            'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+                            'text/plain', 'text/markdown'}),
+    'text': frozenset({'text/plain', 'text/markdown', 'application/json', 'text/csv'}),
+    'videos': frozenset({'video/mp4', 'video/avi', 'video/mov', 'video/webm', 'video/mkv', 'video/quicktime'}),
+    'media': frozenset({'audio/mpeg', 'audio/wav', 'video/mp4', 'video/avi'})
+}
+
+# MIME type prefixes matched by the `type` filter of the search endpoint
+SEARCH_TYPE_PREFIXES = {
+    'images': ('image/',),
+    'documents': ('application/pdf', 'application/msword', 'text/'),
+    'text': ('text/',),
+    'videos': ('video/',),
+}
+
+# Sort keys for the file listing (name sorting uses the lowercase name index)
+SORT_KEYS = {
+    'size': itemgetter('size'),
+    'date': itemgetter('upload_date'),
+}
+
+# Trash purging runs in batches and backs off while uploads/downloads are active
+TRASH_PURGE_BULK = int(os.environ.get('TRASH_PURGE_BULK', 50))  # Files per batch
+TRASH_PURGE_PAUSE = float(os.environ.get('TRASH_PURGE_PAUSE', 0.05))  # Seconds between busy batches
+TRASH_SWEEP_INTERVAL = int(os.environ.get('TRASH_SWEEP_INTERVAL', 3600))  # Seconds between expiry sweeps
+FOREGROUND_ENDPOINTS = frozenset({
+    'upload_file', 'download_file', 'preview_file', 'batch_download', 'download_compressed_file'
+})
+
+# Worker threads for removing files on disk during batch operations
+_UNLINK_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix='unlink')
+
+# Image/PDF compression is CPU-bound, so it runs in worker processes that
+# don't share the GIL with request threads. 0 compresses in the request thread.
+COMPRESS_WORKERS = int(os.environ.get('COMPRESS_WORKERS', os.cpu_count() or 1))
+_COMPRESS_POOL = {'pool': None}
+_COMPRESS_POOL_LOCK = threading.Lock()
+# Workers are not forked from the serving process: a fork would copy locks
+# held by its request and background threads and could deadlock on them
+COMPRESS_MP_CONTEXT = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+# Already-compressed formats are stored as-is in ZIP archives; deflating them
+# burns CPU for next to no size reduction.
+INCOMPRESSIBLE_EXTENSIONS = frozenset({
+    'mp4', 'mp3', 'jpg', 'jpeg', 'png', 'gif', 'zip', 'gz', 'tar',
+    'docx', 'xlsx', 'pptx', 'pdf', 'mov', 'avi', 'wav'
+})
+INCOMPRESSIBLE_TYPES = frozenset({
+    'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'video/mp4',
+    'video/quicktime', 'video/webm', 'audio/mpeg', 'application/pdf',
+    'application/zip', 'application/gzip', 'application/x-7z-compressed',
+    'application/x-rar-compressed'
+})
 
 # Default settings
 DEFAULT_SETTINGS = {
     'upload_dir': UPLOAD_DIR,
     'download_dir': '',
     'theme': 'dark',
+    'jpeg_encoder': 'fast',  # 'fast' (libjpeg-turbo) or 'small' (jpegli, smaller files)
     'max_file_size': MAX_FILE_SIZE
 }
 
 
-def load_settings():
-    """Load application settings from disk."""
-    if os.path.exists(SETTINGS_FILE):
+class StagedUpload(io.FileIO):
+    """Temporary file inside UPLOAD_DIR that a multipart file part is parsed into.
+
+    Because it lives on the same filesystem as the final location, the upload
+    handler can move it into place instead of copying the bytes a second time.
+    Bytes are counted as they arrive; a part that grows past MAX_FILE_SIZE is
+    truncated and the rest of it discarded. The parser hands over small
+    chunks, so they are collected into STAGING_BUFFER_SIZE writes. The file
+    is removed on close unless it was moved.
+    """
+    
+    def __init__(self):
+        self.path = os.path.join(UPLOAD_DIR, f'.upload-{secrets.token_hex(8)}')
+        self.moved = False
+        self.size = 0
+        self.oversized = False
+        self._buffer = bytearray()
+        super().__init__(self.path, 'x+b')
+    
+    def write(self, data):
+        if self.oversized:
+            return len(data)
+        self.size += len(data)
+        if self.size > MAX_FILE_SIZE:
+            self.oversized = True
+            self._buffer.clear()
+            self.truncate(0)
+            return len(data)
+        self._buffer += data
+        if len(self._buffer) >= STAGING_BUFFER_SIZE:
+            self.flush()
+        return len(data)
+    
+    def flush(self):
+        if self._buffer and not self.closed:
+            view = memoryview(self._buffer)
+            while view:
+                view = view[super().write(view):]
+            view.release()
+            self._buffer.clear()
+        super().flush()
+    
+    def seek(self, *args):
+        self.flush()
+        return super().seek(*args)
+    
+    def tell(self):
+        self.flush()
+        return super().tell()
+    
+    def read(self, *args):
+        self.flush()
+        return super().read(*args)
+    
+    def move_to(self, destination):
+        """Close the staging file and move it to its final path."""
+        self.flush()
+        super().close()
+        move_file(self.path, destination)
+        self.moved = True
+    
+    def close(self):
+        super().close()
+        if not self.moved:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class UploadRequest(Request):
+    """Request that parses uploaded files straight into UPLOAD_DIR."""
+    
+    # Cap the in-memory size of plain form fields; file parts always stream
+    # to disk through _get_file_stream
+    max_form_memory_size = 1024 * 1024
+    
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        return StagedUpload()
+
+
+app.request_class = UploadRequest
+
+
+def parse_json(data):
+    """Parse JSON text or bytes, using orjson when available."""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dump_json(obj, indent=True):
+    """Serialize an object to JSON bytes, using orjson when available."""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else None)
+    if indent:
+        return json.dumps(obj, indent=2).encode('utf-8')
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def pack_json(obj):
+    """Serialize a store for disk: compact JSON, zstd-compressed when available."""
+    data = dump_json(obj, indent=False)
+    if ZSTD_AVAILABLE:
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return data
+
+
+def unpack_json(data):
+    """Parse a store written by pack_json() or plain JSON.
+
+    Raises ValueError for a corrupt store, whether it is damaged JSON or a
+    damaged zstd frame.
+    """
+    if data[:4] == ZSTD_MAGIC:
+        if not ZSTD_AVAILABLE:
+            # Treating the store as empty would overwrite it on the next save
+            raise RuntimeError('A zstd-compressed store was found but zstandard is not installed')
+        try:
+            data = zstandard.ZstdDecompressor().decompress(data)
+        except zstandard.ZstdError as e:
+            raise ValueError(f'Corrupt zstd store: {e}') from e
+    return parse_json(data)
+
+
+def dump_json_line(obj):
+    """Serialize an object to a single newline-terminated line of JSON bytes."""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson, used for every jsonify() response."""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default,
+                            option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the response instead of
+        # decoding them to str only for Werkzeug to encode them again
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default,
+                            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+if ORJSON_AVAILABLE:
+    app.json = ORJSONProvider(app)
+
+
+def write_atomic(path, data):
+    """Replace a file with new contents via a synced temporary file.
+
+    The data is fsynced before the rename, so a crash leaves either the old
+    or the new contents on disk, never a truncated file.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def store_files(path, compress=True):
+    """Return the files a store at path may live in, in the order they are read.
+
+    Compressed stores are written to path + '.zst'; the plain JSON file is
+    still read when there is no compressed copy yet.
+    """
+    return (path + '.zst', path) if compress else (path,)
+
+
+def read_store(path, compress=True):
+    """Read a store written by write_store(), or None if it doesn't exist.
+
+    A file that can't be decoded is renamed to <name>.corrupt and
+    ValueError is raised, so the caller's next write can't destroy it.
+    """
+    for candidate in store_files(path, compress):
         try:
-            with open(SETTINGS_FILE, 'r') as f:
-                settings = json.load(f)
-                return {**DEFAULT_SETTINGS, **settings}
-        except (json.JSONDecodeError, IOError):
-            return DEFAULT_SETTINGS.copy()
-    return DEFAULT_SETTINGS.copy()
+            with open(candidate, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            continue
+        try:
+            return unpack_json(data)
+        except ValueError as e:
+            app.logger.error("Unreadable store %s kept as %s.corrupt: %s", candidate, candidate, e)
+            os.replace(candidate, candidate + '.corrupt')
+            raise
+    return None
+
+
+def write_store(path, obj, compress=True):
+    """Write a store atomically, zstd-compressed to path + '.zst' when available.
+
+    The plain JSON file it replaces is removed once the compressed copy is
+    in place, so an older build never reads outdated data from it.
+    """
+    if compress and ZSTD_AVAILABLE:
+        write_atomic(path + '.zst', pack_json(obj))
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    else:
+        write_atomic(path, dump_json(obj, indent=not compress))
+
+
+class CachedJSONFile:
+    """A JSON document on disk that is parsed once and re-read only when it changes.
+
+    The cache is keyed on the file's (st_mtime_ns, st_size), so edits made
+    outside the app are still picked up. load() returns the cached object
+    itself; callers that mutate it must hand it back to save(). Stores
+    created with deferred=True only mark themselves dirty on save() and are
+    written by the background flusher; compress=True stores them with
+    write_store() under a .zst name instead of as indented JSON.
+    """
+    
+    def __init__(self, path, default, deferred=False, compress=False):
+        self.path = path
+        self.default = default
+        self.deferred = deferred
+        self.compress = compress
+        self._key = None
+        self._obj = None
+        self._dirty = False
+        self._lock = threading.RLock()
+    
+    def _stat_key(self):
+        key = []
+        for path in store_files(self.path, self.compress):
+            try:
+                st = os.stat(path)
+            except OSError:
+                key.append(None)
+            else:
+                key.append((st.st_mtime_ns, st.st_size))
+        return tuple(key)
+    
+    def load(self):
+        with self._lock:
+            key = self._stat_key()
+            # Unwritten changes win over whatever is on disk
+            if self._obj is None or (not self._dirty and key != self._key):
+                obj = None
+                try:
+                    obj = read_store(self.path, self.compress)
+                except (ValueError, OSError):
+                    key = self._stat_key()
+                self._obj = obj if obj is not None else self.default()
+                self._key = key
+            return self._obj
+    
+    def save(self, obj):
+        with self._lock:
+            self._obj = obj
+            self._dirty = True
+            if not self.deferred:
+                self.flush()
+        if self.deferred:
+            _FLUSH_EVENT.set()
+    
+    def flush(self):
+        """Write the cached object to disk atomically if it has unsaved changes."""
+        with self._lock:
+            if not self._dirty:
+                return
+            write_store(self.path, self._obj, self.compress)
+            self._key = self._stat_key()
+            self._dirty = False
+
+
+_SETTINGS_STORE = CachedJSONFile(SETTINGS_FILE, dict, deferred=True)
+_TRASH_STORE = CachedJSONFile(TRASH_FILE, lambda: {'deleted_files': {}}, deferred=True, compress=True)
+
+
+def load_settings():
+    """Load application settings, merged over the defaults."""
+    return {**DEFAULT_SETTINGS, **_SETTINGS_STORE.load()}
 
 
 def save_settings(settings):
     """Save application settings to disk."""
-    with open(SETTINGS_FILE, 'w') as f:
-        json.dump(settings, f, indent=2)
+    _SETTINGS_STORE.save(settings)
+
+
+# Parsed metadata is cached in memory and only re-read when the file on disk
+# changes underneath us (e.g. edited by hand or restored from a backup).
+# Derived indexes live next to it and are rebuilt whenever the data is.
+# Changes are appended to a journal of per-file records and periodically
+# folded back into the snapshot, so a mutation never rewrites every record.
+_META_CACHE = {
+    'data': None,
+    'mtime': (0, 0),
+    'generation': 0,
+    'journal_entries': 0,
+    'pending_files': set(),
+    'pending_folders': [],
+    'rewrite': False,
+    'folder_index': defaultdict(Counter),
+    'folder_files': defaultdict(set),
+    'folder_children': {},
+    'folder_set': {'root'},
+    'names_lc': {},
+    'ngrams': defaultdict(set),
+    'total_size': 0,
+    'type_counts': Counter(),
+    'dirty': False,
+    'writing': False
+}
+_META_LOCK = threading.RLock()
 
+# Per-folder locks so uploads into different folders don't wait on each other;
+# the shared dict itself is only touched under _META_LOCK
+_STRIPE_LOCKS = [threading.Lock() for _ in range(32)]
+_FLUSH_EVENT = threading.Event()
+_FLUSH_LOCK = threading.Lock()
 
-def load_metadata():
-    """Load file metadata from disk."""
-    if os.path.exists(METADATA_FILE):
-        try:
-            with open(METADATA_FILE, 'r') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, IOError):
-            return {'files': {}, 'folders': ['root']}
+
+def folder_lock(folder_path):
+    """Return the stripe lock guarding a folder."""
+    return _STRIPE_LOCKS[hash(folder_path) % len(_STRIPE_LOCKS)]
+
+
+def _empty_metadata():
     return {'files': {}, 'folders': ['root']}
 
 
+def _ngrams(text):
+    """Return the set of two- and three-character substrings of a string."""
+    grams = {text[i:i + 2] for i in range(len(text) - 1)}
+    grams.update(text[i:i + 3] for i in range(len(text) - 2))
+    return grams
+
+
+def _parent_folder(folder_path):
+    return folder_path.rsplit('/', 1)[0] if '/' in folder_path else 'root'
+
+
+def _link_folder(known, folder_path):
+    """Mark a folder and any missing ancestors as known.
+
+    Returns the newly known folders, outermost first.
+    """
+    linked = []
+    while folder_path not in known:
+        known.add(folder_path)
+        linked.append(folder_path)
+        folder_path = _parent_folder(folder_path)
+    linked.reverse()
+    return linked
+
+
+def _rebuild_indexes(metadata):
+    """Recompute the derived indexes from scratch in a single pass."""
+    children = defaultdict(list)
+    folder_set = {'root'}
+    for folder in metadata.get('folders', []):
+        for path in _link_folder(folder_set, folder):
+            children[_parent_folder(path)].append(path)
+    # Tuples are replaced rather than mutated, so listings can read them without the lock
+    folder_children = {parent: tuple(paths) for parent, paths in children.items()}
+    # Names are counted, since a rename can leave two files with the same name
+    folder_index = defaultdict(Counter)
+    folder_files = defaultdict(set)
+    names_lc = {}
+    ngrams = defaultdict(set)
+    total_size = 0
+    icons = []
+    for file_id, f in metadata.get('files', {}).items():
+        folder_index[f.get('folder_path', 'root')][f['filename']] += 1
+        folder_files[f.get('folder_path', 'root')].add(file_id)
+        name_lc = f['filename'].lower()
+        names_lc[file_id] = name_lc
+        for gram in _ngrams(name_lc):
+            ngrams[gram].add(file_id)
+        total_size += f.get('size', 0)
+        icons.append(f.get('icon', 'file'))
+    # Counter() tallies a list in C, about twice as fast as += per file
+    type_counts = Counter(icons)
+    _META_CACHE['folder_index'] = folder_index
+    _META_CACHE['folder_files'] = folder_files
+    _META_CACHE['folder_children'] = folder_children
+    _META_CACHE['folder_set'] = folder_set
+    _META_CACHE['names_lc'] = names_lc
+    _META_CACHE['ngrams'] = ngrams
+    _META_CACHE['total_size'] = total_size
+    _META_CACHE['type_counts'] = type_counts
+
+
+def index_file(file_info):
+    """Add a file record to the derived indexes and the pending journal."""
+    with _META_LOCK:
+        _META_CACHE['pending_files'].add(file_info['id'])
+        _META_CACHE['folder_index'][file_info.get('folder_path', 'root')][file_info['filename']] += 1
+        _META_CACHE['folder_files'][file_info.get('folder_path', 'root')].add(file_info['id'])
+        name_lc = file_info['filename'].lower()
+        _META_CACHE['names_lc'][file_info['id']] = name_lc
+        for gram in _ngrams(name_lc):
+            _META_CACHE['ngrams'][gram].add(file_info['id'])
+        _META_CACHE['total_size'] += file_info.get('size', 0)
+        _META_CACHE['type_counts'][file_info.get('icon', 'file')] += 1
+
+
+def unindex_file(file_info):
+    """Remove a file record from the derived indexes and note it for the journal."""
+    with _META_LOCK:
+        _META_CACHE['pending_files'].add(file_info['id'])
+        names = _META_CACHE['folder_index'][file_info.get('folder_path', 'root')]
+        names[file_info['filename']] -= 1
+        if names[file_info['filename']] <= 0:
+            del names[file_info['filename']]
+        _META_CACHE['folder_files'][file_info.get('folder_path', 'root')].discard(file_info['id'])
+        name_lc = _META_CACHE['names_lc'].pop(file_info['id'], '')
+        ngrams = _META_CACHE['ngrams']
+        for gram in _ngrams(name_lc):
+            postings = ngrams.get(gram)
+            if postings is not None:
+                postings.discard(file_info['id'])
+                if not postings:
+                    del ngrams[gram]
+        _META_CACHE['total_size'] -= file_info.get('size', 0)
+        type_counts = _META_CACHE['type_counts']
+        icon = file_info.get('icon', 'file')
+        type_counts[icon] -= 1
+        if type_counts[icon] <= 0:
+            del type_counts[icon]
+
+
+def find_by_name(query):
+    """Return (file_id, lowercase name) pairs whose name contains the query.
+
+    Candidates come from intersecting the n-gram postings of the query (its
+    trigrams, or the query itself when it is two characters long) and are
+    then verified with a substring check; single-character queries fall
+    back to scanning the lowercase names.
+    """
+    if len(query) >= 3:
+        grams = {query[i:i + 3] for i in range(len(query) - 2)}
+    elif len(query) == 2:
+        grams = {query}
+    else:
+        grams = None
+    with _META_LOCK:
+        names_lc = _META_CACHE['names_lc']
+        if grams:
+            ngrams = _META_CACHE['ngrams']
+            postings = sorted((ngrams.get(g, set()) for g in grams), key=len)
+            candidates = postings[0].intersection(*postings[1:])
+        else:
+            candidates = names_lc
+        return [(file_id, names_lc[file_id]) for file_id in candidates
+                if query in names_lc[file_id]]
+
+
+def add_folder(metadata, folder_path):
+    """Record a folder (and any missing parents) in the metadata and folder tree."""
+    with _META_LOCK:
+        linked = _link_folder(_META_CACHE['folder_set'], folder_path)
+        children = _META_CACHE['folder_children']
+        for path in linked:
+            parent = _parent_folder(path)
+            children[parent] = children.get(parent, ()) + (path,)
+        metadata['folders'].extend(linked)
+        _META_CACHE['pending_folders'].extend(linked)
+
+
+def folder_exists(folder_path):
+    """Check whether a folder is known."""
+    return folder_path in _META_CACHE['folder_set']
+
+
+def get_files_in_folder(folder_path):
+    """Return the file records directly inside a folder."""
+    with _META_LOCK:
+        files = load_metadata()['files']
+        return [files[file_id] for file_id in _META_CACHE['folder_files'].get(folder_path, ())]
+
+
+def name_taken(folder_path, filename):
+    """Check whether a filename is already used in a folder."""
+    return filename in _META_CACHE['folder_index'].get(folder_path, ())
+
+
+def _metadata_mtime():
+    """Return the modification times of the snapshot files and the journal."""
+    mtimes = []
+    for path in (*store_files(METADATA_FILE), METADATA_JOURNAL):
+        try:
+            mtimes.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            mtimes.append(0)
+    return tuple(mtimes)
+
+
+def _replay_journal(data, generation, snapshot_loaded):
+    """Apply journal entries written on top of the given snapshot generation.
+
+    Returns the number of entries applied and whether the whole journal was
+    readable. A journal from an older generation than a snapshot that loaded
+    fine was already folded into it (a crash between writing the snapshot
+    and removing the journal) and is deleted. When the snapshot is missing,
+    unreadable or older than the journal, the journal is the only copy of
+    its changes and is replayed regardless. Replay stops at a torn line from
+    an interrupted append.
+    """
+    try:
+        with open(METADATA_JOURNAL, 'rb') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return 0, True
+    
+    try:
+        journal_generation = parse_json(lines[0]).get('generation') if lines else None
+    except json.JSONDecodeError:
+        return 0, False
+    if (snapshot_loaded and journal_generation != generation
+            and (journal_generation is None or journal_generation < generation)):
+        try:
+            os.remove(METADATA_JOURNAL)
+        except OSError:
+            pass
+        return 0, True
+    
+    folders = set(data['folders'])
+    applied = 0
+    for line in lines:
+        try:
+            entry = parse_json(line)
+        except json.JSONDecodeError:
+            return applied, False
+        if 'generation' in entry:
+            # The header, or a stray one appended by an older bug
+            continue
+        if 'folder' in entry:
+            if entry['folder'] not in folders:
+                folders.add(entry['folder'])
+                data['folders'].append(entry['folder'])
+        elif entry['file'] is None:
+            data['files'].pop(entry['id'], None)
+        else:
+            data['files'][entry['id']] = entry['file']
+        applied += 1
+    return applied, True
+
+
+def load_metadata():
+    """Load file metadata, re-parsing it only when it changed on disk."""
+    with _META_LOCK:
+        mtime = _metadata_mtime()
+        
+        # Pending in-memory changes win over whatever is on disk
+        pending = _META_CACHE['dirty'] or _META_CACHE['writing']
+        stale = not pending and mtime != _META_CACHE['mtime']
+        if _META_CACHE['data'] is None or stale:
+            try:
+                data = read_store(METADATA_FILE)
+            except (ValueError, OSError):
+                # A corrupt snapshot was moved aside; the journal still replays
+                data = None
+                mtime = _metadata_mtime()
+            snapshot_loaded = data is not None
+            if not snapshot_loaded:
+                data = _empty_metadata()
+            generation = data.pop('generation', 0)
+            _META_CACHE['data'] = data
+            _META_CACHE['mtime'] = mtime
+            _META_CACHE['generation'] = generation
+            applied, complete = _replay_journal(data, generation, snapshot_loaded)
+            _META_CACHE['journal_entries'] = applied
+            _META_CACHE['pending_files'] = set()
+            _META_CACHE['pending_folders'] = []
+            _rebuild_indexes(data)
+            if not complete:
+                # Don't append after a damaged journal; fold it into a new snapshot
+                _META_CACHE['rewrite'] = True
+                _META_CACHE['dirty'] = True
+                _FLUSH_EVENT.set()
+        
+        return _META_CACHE['data']
+
+
 def save_metadata(metadata):
-    """Save file metadata to disk."""
-    with open(METADATA_FILE, 'w') as f:
-        json.dump(metadata, f, indent=2)
+    """Update the cached metadata and schedule a write to disk.
+
+    Writes are coalesced by the background flusher, so a burst of uploads
+    or deletes results in a single append to the metadata journal.
+    """
+    with _META_LOCK:
+        if metadata is not _META_CACHE['data']:
+            _rebuild_indexes(metadata)
+            _META_CACHE['rewrite'] = True
+        _META_CACHE['data'] = metadata
+        _META_CACHE['dirty'] = True
+    _FLUSH_EVENT.set()
+
+
+def _take_snapshot():
+    """Capture the metadata for a snapshot rewrite and start a new journal generation.
+
+    Called under _META_LOCK; the returned dict is encoded after the lock is
+    released, so the file table is copied rather than shared. The records
+    themselves are shared: views replace a changed record instead of
+    mutating it.
+    """
+    generation = _META_CACHE['generation'] + 1
+    data = _META_CACHE['data']
+    _META_CACHE['generation'] = generation
+    _META_CACHE['journal_entries'] = 0
+    return {**data, 'files': dict(data['files']), 'folders': list(data['folders']),
+            'generation': generation}
+
+
+def _write_snapshot(snapshot):
+    """Write a snapshot taken by _take_snapshot() and drop the old journal."""
+    # Nobody reads the snapshot by hand, so it is stored compact and compressed
+    write_store(METADATA_FILE, snapshot)
+    try:
+        os.remove(METADATA_JOURNAL)
+    except FileNotFoundError:
+        pass
+
+
+def _take_journal():
+    """Encode the records changed since the last flush as journal lines.
+
+    Called under _META_LOCK; only the changed records are serialized here.
+    Returns the payload and whether it starts a new journal.
+    """
+    files = _META_CACHE['data']['files']
+    lines = [dump_json_line({'folder': folder}) for folder in _META_CACHE['pending_folders']]
+    lines.extend(dump_json_line({'id': file_id, 'file': files.get(file_id)})
+                 for file_id in _META_CACHE['pending_files'])
+    fresh = not _META_CACHE['journal_entries']
+    if fresh:
+        lines.insert(0, dump_json_line({'generation': _META_CACHE['generation']}))
+    _META_CACHE['journal_entries'] += len(lines)
+    return b''.join(lines), fresh
+
+
+def _append_journal(payload, fresh):
+    """Write lines produced by _take_journal() to the journal.
+
+    A fresh journal replaces whatever file is there, so its header is
+    always the first line.
+    """
+    with open(METADATA_JOURNAL, 'wb' if fresh else 'ab') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _journal_full():
+    """Check whether the journal is due to be folded into the snapshot.
+
+    The limit grows with the number of files, so the O(N) snapshot rewrite
+    happens at most once per N journal entries and each mutation costs O(1)
+    amortized regardless of library size.
+    """
+    limit = max(JOURNAL_COMPACT_ENTRIES, len(_META_CACHE['data']['files']))
+    return _META_CACHE['journal_entries'] >= limit
+
+
+def flush_metadata(compact=False):
+    """Write pending metadata changes to disk.
+
+    Changed records are appended to the journal; the snapshot is rewritten
+    atomically when the journal outgrows the snapshot, when the
+    whole metadata dict was replaced, or when compact is True.
+
+    Only capturing the changes happens under _META_LOCK; encoding the
+    snapshot and the disk write run after it is released, so requests
+    aren't held up by a large rewrite. _FLUSH_LOCK keeps flushes in order.
+    """
+    with _FLUSH_LOCK:
+        with _META_LOCK:
+            pending = (_META_CACHE['rewrite'] or _META_CACHE['pending_files']
+                       or _META_CACHE['pending_folders'])
+            if not pending and not compact:
+                # Nothing to write; an empty append would only add a header
+                _META_CACHE['dirty'] = False
+                return
+            if (compact or _META_CACHE['rewrite']
+                    or _journal_full()):
+                snapshot, journal = _take_snapshot(), None
+            else:
+                snapshot, journal = None, _take_journal()
+            _META_CACHE['pending_files'] = set()
+            _META_CACHE['pending_folders'] = []
+            _META_CACHE['rewrite'] = False
+            _META_CACHE['dirty'] = False
+            _META_CACHE['writing'] = True
+        
+        try:
+            if snapshot is not None:
+                _write_snapshot(snapshot)
+            else:
+                _append_journal(*journal)
+        except BaseException:
+            with _META_LOCK:
+                # The captured changes are gone; a full rewrite restores them
+                _META_CACHE['rewrite'] = True
+                _META_CACHE['dirty'] = True
+                _META_CACHE['writing'] = False
+            raise
+        
+        with _META_LOCK:
+            _META_CACHE['mtime'] = _metadata_mtime()
+            _META_CACHE['writing'] = False
 
 
-def load_trash():
-    """Load deleted files from trash."""
-    if os.path.exists(TRASH_FILE):
+def flush_pending_writes():
+    """Write out every deferred change (metadata, trash and settings)."""
+    flush_metadata()
+    _TRASH_STORE.flush()
+    _SETTINGS_STORE.flush()
+
+
+def _metadata_flusher():
+    """Flush deferred writes at most once per METADATA_FLUSH_INTERVAL."""
+    while True:
+        _FLUSH_EVENT.wait()
+        time.sleep(METADATA_FLUSH_INTERVAL)
+        _FLUSH_EVENT.clear()
         try:
-            with open(TRASH_FILE, 'r') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, IOError):
-            return {'deleted_files': {}}
-    return {'deleted_files': {}}
+            flush_pending_writes()
+        except Exception:
+            # Keep the thread alive; the failed flush left its changes pending
+            app.logger.exception("Failed to write metadata")
+            _FLUSH_EVENT.set()
+
+
+def locked_metadata(view):
+    """Serialize a view's load -> mutate -> save sequence on the shared metadata."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        with _META_LOCK:
+            return view(*args, **kwargs)
+    return wrapper
+
+
+def load_trash():
+    """Load deleted files from trash (cached until the file changes)."""
+    return _TRASH_STORE.load()
 
 
 def save_trash(trash):
     """Save deleted files to trash."""
-    with open(TRASH_FILE, 'w') as f:
-        json.dump(trash, f, indent=2)
+    _TRASH_STORE.save(trash)
 
 
-def move_to_trash(file_id, file_info):
-    """Move a deleted file to trash for potential recovery."""
+def move_to_trash(file_id, file_info, trash_path, save=True):
+    """Record a deleted file in the trash for potential recovery.
+
+    trash_path is where stash_file() put the bytes (None if there were none).
+    Pass save=False when trashing several files and call save_trash() once.
+    """
     trash = load_trash()
     if 'deleted_files' not in trash:
         trash['deleted_files'] = {}
     
+    now = datetime.now(timezone.utc)
     trash['deleted_files'][file_id] = {
         'file_info': file_info,
-        'deleted_at': datetime.now(timezone.utc).isoformat(),
-        'expires_at': (datetime.now(timezone.utc) + 
-                      __import__('datetime').timedelta(seconds=TRASH_EXPIRY)).isoformat()
+        'trash_path': trash_path,
+        'deleted_at': now.isoformat(),
+        'expires_at': (now + TRASH_EXPIRY_DELTA).isoformat()
     }
-    save_trash(trash)
+    if save:
+        save_trash(trash)
+
+
+# Error code -> (status, message) for a failed restore_from_trash()
+RESTORE_ERRORS = {
+    'NOT_IN_TRASH': (404, 'File not found in trash'),
+    'TRASH_EXPIRED': (410, 'File recovery period expired (24 hours). File permanently deleted.'),
+    'TRASH_FILE_MISSING': (404, 'The deleted file is no longer on disk'),
+    'RESTORE_ERROR': (500, 'Could not move the file out of the trash'),
+}
 
 
 def restore_from_trash(file_id):
-    """Restore a file from trash."""
+    """Restore a file from trash.
+
+    Returns None on success, otherwise a key of RESTORE_ERRORS.
+    """
     trash = load_trash()
     
     if file_id not in trash.get('deleted_files', {}):
-        return False
+        return 'NOT_IN_TRASH'
     
     trash_entry = trash['deleted_files'][file_id]
     file_info = trash_entry['file_info']
@@ -145,15 +1008,31 @@ def restore_from_trash(file_id):
         # Trash expired, file can't be recovered
         del trash['deleted_files'][file_id]
         save_trash(trash)
-        return False
+        if trash_entry.get('trash_path'):
+            remove_file(trash_entry['trash_path'])
+        return 'TRASH_EXPIRED'
+    
+    # Put the bytes back where they were (a rename on the same filesystem)
+    trash_path = trash_entry.get('trash_path')
+    if trash_path:
+        try:
+            move_file(trash_path, file_info['file_path'])
+        except FileNotFoundError:
+            # Nothing left to recover; drop the entry
+            del trash['deleted_files'][file_id]
+            save_trash(trash)
+            return 'TRASH_FILE_MISSING'
+        except OSError as e:
+            app.logger.warning("Failed to restore %s from trash: %s", file_id, e)
+            return 'RESTORE_ERROR'
     
     # Restore file to metadata
     metadata = load_metadata()
     metadata['files'][file_id] = file_info
+    index_file(file_info)
     
     # Ensure folder exists
-    if file_info.get('folder_path') not in metadata.get('folders', []):
-        metadata['folders'].append(file_info.get('folder_path', 'root'))
+    add_folder(metadata, file_info.get('folder_path', 'root'))
     
     save_metadata(metadata)
     
@@ -161,59 +1040,344 @@ def restore_from_trash(file_id):
     del trash['deleted_files'][file_id]
     save_trash(trash)
     
-    return True
+    return None
+
+
+ICON_MAP = {
+    'pdf': 'file-text',
+    'doc': 'file-text',
+    'docx': 'file-text',
+    'txt': 'file-text',
+    'md': 'file-text',
+    'json': 'code',
+    'csv': 'table',
+    'xlsx': 'table',
+    'xls': 'table',
+    'png': 'image',
+    'jpg': 'image',
+    'jpeg': 'image',
+    'gif': 'image',
+    'mp3': 'music',
+    'wav': 'music',
+    'mp4': 'video',
+    'avi': 'video',
+    'mov': 'video',
+    'zip': 'archive',
+    'tar': 'archive',
+    'gz': 'archive',
+}
+
+
+def file_extension(filename):
+    """Return the lowercase extension of a filename, or '' if it has none."""
+    _, dot, ext = filename.rpartition('.')
+    return ext.lower() if dot else ''
 
 
 def get_file_icon(mime_type, filename):
     """Return appropriate icon class based on file type."""
-    ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
-    
-    icon_map = {
-        'pdf': 'file-text',
-        'doc': 'file-text',
-        'docx': 'file-text',
-        'txt': 'file-text',
-        'md': 'file-text',
-        'json': 'code',
-        'csv': 'table',
-        'xlsx': 'table',
-        'xls': 'table',
-        'png': 'image',
-        'jpg': 'image',
-        'jpeg': 'image',
-        'gif': 'image',
-        'mp3': 'music',
-        'wav': 'music',
-        'mp4': 'video',
-        'avi': 'video',
-        'mov': 'video',
-        'zip': 'archive',
-        'tar': 'archive',
-        'gz': 'archive',
-    }
-    
-    return icon_map.get(ext, 'file')
+    return ICON_MAP.get(file_extension(filename), 'file')
+
+
+@lru_cache(maxsize=256)
+def _mime_type_for_suffix(suffix):
+    return mimetypes.guess_type(f'file.{suffix}')[0]
+
+
+def guess_mime_type(filename):
+    """Guess a file's MIME type, caching the lookup per extension."""
+    parts = filename.lower().rsplit('.', 2)
+    if len(parts) == 1:
+        return None
+    suffix = parts[-1]
+    # Compression suffixes (.tar.gz) take their type from the inner extension
+    if len(parts) == 3 and f'.{suffix}' in mimetypes.encodings_map:
+        suffix = f'{parts[-2]}.{suffix}'
+    return _mime_type_for_suffix(suffix)
 
 
 def allowed_file(filename):
     """Check if file extension is allowed."""
-    if '.' not in filename:
-        return False
-    ext = filename.rsplit('.', 1)[1].lower()
-    return ext in ALLOWED_EXTENSIONS
+    ext = file_extension(filename)
+    return bool(ext) and ext in ALLOWED_EXTENSIONS
+
+
+SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB')
 
 
 def format_file_size(size_bytes):
     """Format file size in human-readable format."""
-    for unit in ['B', 'KB', 'MB', 'GB']:
-        if size_bytes < 1024:
-            return f"{size_bytes:.1f} {unit}"
-        size_bytes /= 1024
-    return f"{size_bytes:.1f} TB"
+    # floor(log1024(size)) straight from the bit length, no division loop
+    exponent = min(max((int(size_bytes).bit_length() - 1) // 10, 0), len(SIZE_UNITS) - 1)
+    return f"{size_bytes / (1 << (10 * exponent)):.1f} {SIZE_UNITS[exponent]}"
+
+
+MAX_FILE_SIZE_FORMATTED = format_file_size(MAX_FILE_SIZE)  # Used by every size-limit error
+
+
+_ID_ENTROPY = threading.local()
+ID_ENTROPY_POOL_SIZE = 4096  # bytes of os.urandom() fetched per refill
+
+
+def generate_file_id():
+    """Return a random 128-bit file ID as 32 hex characters.
+
+    IDs are sliced from a per-thread pool of random bytes so a burst of
+    uploads does not cost one urandom read per file.
+    """
+    pool = getattr(_ID_ENTROPY, 'pool', b'')
+    offset = getattr(_ID_ENTROPY, 'offset', 0)
+    if offset + 16 > len(pool):
+        pool = os.urandom(ID_ENTROPY_POOL_SIZE)
+        offset = 0
+        _ID_ENTROPY.pool = pool
+    _ID_ENTROPY.offset = offset + 16
+    return pool[offset:offset + 16].hex()
+
+
+def move_file(src, dst):
+    """Rename a file to dst, creating dst's folder only if the rename says it is missing.
+
+    Falls back to shutil.move when the two paths are on different filesystems.
+    """
+    try:
+        os.rename(src, dst)
+    except FileNotFoundError:
+        # Either src is gone (the retry raises again) or dst's folder is missing
+        Path(dst).parent.mkdir(parents=True, exist_ok=True)
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst)
+
+
+def stash_file(file_id, file_path):
+    """Move a file into TRASH_DIR so it can be restored later.
+
+    Returns (trash_path, error); trash_path is None when the file was
+    already gone, error is a message on failure.
+    """
+    trash_path = os.path.join(TRASH_DIR, file_id)
+    try:
+        move_file(file_path, trash_path)
+    except FileNotFoundError:
+        return None, None
+    except OSError as e:
+        return None, str(e)
+    return trash_path, None
+
+
+def remove_file(file_path):
+    """Delete a file, treating an already-missing file as success.
+
+    Returns an error message on failure, or None.
+    """
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        return str(e)
+    return None
+
+
+_FOREGROUND_IO = {'active': 0, 'last': 0.0}
+_FOREGROUND_LOCK = threading.Lock()
+
+
+def foreground_busy():
+    """Check whether an upload or download is running or ended within the last second."""
+    return _FOREGROUND_IO['active'] > 0 or time.monotonic() - _FOREGROUND_IO['last'] < 1.0
+
+
+def _foreground_done():
+    """Record the end of a transfer counted by note_foreground_io()."""
+    with _FOREGROUND_LOCK:
+        _FOREGROUND_IO['active'] -= 1
+        _FOREGROUND_IO['last'] = time.monotonic()
+
+
+def purge_files(paths):
+    """Delete files in parallel batches of TRASH_PURGE_BULK.
+
+    Pauses between batches while transfers are running so a large purge
+    doesn't starve them of disk I/O. Returns the number of files removed.
+    """
+    removed = 0
+    for start in range(0, len(paths), TRASH_PURGE_BULK):
+        batch = paths[start:start + TRASH_PURGE_BULK]
+        removed += sum(1 for error in _UNLINK_POOL.map(remove_file, batch) if error is None)
+        if start + TRASH_PURGE_BULK < len(paths) and foreground_busy():
+            time.sleep(TRASH_PURGE_PAUSE)
+    return removed
+
+
+def sweep_expired_trash():
+    """Drop expired trash entries and delete their files."""
+    now = datetime.now(timezone.utc)
+    paths = []
+    with _META_LOCK:
+        trash = load_trash()
+        deleted_files = trash.get('deleted_files', {})
+        expired = [file_id for file_id, entry in deleted_files.items()
+                   if datetime.fromisoformat(entry['expires_at']) < now]
+        for file_id in expired:
+            trash_path = deleted_files.pop(file_id).get('trash_path')
+            if trash_path:
+                paths.append(trash_path)
+        if expired:
+            save_trash(trash)
+    purge_files(paths)
+
+
+def _trash_sweeper():
+    """Sweep expired trash entries every TRASH_SWEEP_INTERVAL seconds."""
+    while True:
+        time.sleep(TRASH_SWEEP_INTERVAL)
+        try:
+            sweep_expired_trash()
+        except Exception:
+            app.logger.exception("Failed to sweep trash")
+
+
+_STARTUP = {'done': False}
+_STARTUP_LOCK = threading.Lock()
+
+
+def start_serving():
+    """Set up storage and start the background threads, once per serving process.
+
+    Runs on the first request instead of at import, so processes that only
+    import this module, such as compression pool workers, leave the upload
+    directory and the metadata alone.
+    """
+    with _STARTUP_LOCK:
+        if _STARTUP['done']:
+            return
+        # Ensure the storage directories exist and drop staging files left by a crash
+        for path in (UPLOAD_DIR, TRASH_DIR, ZIP_CACHE_DIR, COMPRESS_CACHE_DIR):
+            Path(path).mkdir(parents=True, exist_ok=True)
+        for stale in Path(UPLOAD_DIR).glob('.upload-*'):
+            stale.unlink(missing_ok=True)
+        threading.Thread(target=_metadata_flusher, name='metadata-flusher', daemon=True).start()
+        threading.Thread(target=_trash_sweeper, name='trash-sweeper', daemon=True).start()
+        atexit.register(flush_pending_writes)
+        _STARTUP['done'] = True
+
+
+class ZipStreamSink:
+    """Write-only file object that lets zipfile emit an archive piece by piece.
+
+    zipfile falls back to data descriptors when the target is not seekable,
+    so the archive can be sent to the client while it is being built.
+    """
+    
+    def __init__(self):
+        self._chunks = []
+    
+    def write(self, data):
+        # zipfile may pass a reused buffer, so only bytes can be kept as-is
+        self._chunks.append(data if type(data) is bytes else bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def drain(self):
+        """Return and forget everything written since the last drain."""
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def mark_cache_hit(path):
+    """Record a cache hit for trim_cache_dir in the file's access time.
+
+    The modification time is kept, because send_file() derives the ETag and
+    Last-Modified from it and clients resume or revalidate against those.
+    """
+    st = os.stat(path)
+    os.utime(path, ns=(time.time_ns(), st.st_mtime_ns))
+
+
+def trim_cache_dir(cache_dir, max_bytes):
+    """Delete the least recently used files in a cache directory beyond max_bytes.
+
+    Recency is the access time, which mark_cache_hit() sets on every hit.
+    """
+    stale_before = time.time() - 86400
+    entries = []
+    total = 0
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.endswith('.tmp'):
+                # In-progress writes are skipped; ones left by a crash are cleared
+                if stat.st_mtime < stale_before:
+                    remove_file(entry.path)
+                continue
+            entries.append((stat.st_atime, stat.st_size, entry.path))
+            total += stat.st_size
+    
+    entries.sort()
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        remove_file(path)
+        total -= size
+
+
+def zip_entry_info(file_path, arcname, mime_type=''):
+    """Build a ZipInfo for a file, choosing compression from its type."""
+    zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+    if mime_type in INCOMPRESSIBLE_TYPES or file_extension(arcname) in INCOMPRESSIBLE_EXTENSIONS:
+        zinfo.compress_type = zipfile.ZIP_STORED
+    else:
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        # Level 1 is several times cheaper than the default for a small ratio
+        # loss. ZipInfo only exposes the level publicly from Python 3.13;
+        # older versions read the same setting from _compresslevel.
+        if ZIPINFO_HAS_LEVEL:
+            zinfo.compress_level = 1
+        else:
+            zinfo._compresslevel = 1
+    return zinfo
+
+
+_DISK_USAGE_CACHE = {'value': None, 'time': 0.0}
+_DISK_USAGE_LOCK = threading.Lock()
+DISK_USAGE_TTL = 5.0  # seconds
 
 
 def get_disk_usage():
-    """Get disk usage statistics."""
+    """Get disk usage statistics, refreshed at most every DISK_USAGE_TTL seconds.
+
+    When the reading expires, one thread refreshes it while concurrent
+    requests keep returning the previous one, so a burst of stats calls on
+    a slow (e.g. network) filesystem costs a single statvfs.
+    """
+    value = _DISK_USAGE_CACHE['value']
+    if value is not None and time.monotonic() - _DISK_USAGE_CACHE['time'] <= DISK_USAGE_TTL:
+        return value
+    
+    # Only the very first reading has nothing to fall back on, so wait for it
+    if not _DISK_USAGE_LOCK.acquire(blocking=value is None):
+        return value
+    try:
+        if _DISK_USAGE_CACHE['value'] is value:
+            _DISK_USAGE_CACHE['value'] = _read_disk_usage()
+            _DISK_USAGE_CACHE['time'] = time.monotonic()
+        return _DISK_USAGE_CACHE['value']
+    finally:
+        _DISK_USAGE_LOCK.release()
+
+
+def _read_disk_usage():
+    """Read disk usage statistics for the upload directory."""
     try:
         total, used, free = shutil.disk_usage(UPLOAD_DIR)
         return {
@@ -233,8 +1397,20 @@ def index():
     return render_template('index.html')
 
 
+_LOCAL_IP_CACHE = {'value': None, 'time': 0.0}
+LOCAL_IP_TTL = 60.0  # seconds; re-resolve occasionally in case the host changes networks
+
+
 def get_local_ip():
-    """Get the local IP address of the host machine."""
+    """Get the local IP address of the host machine, refreshed at most every LOCAL_IP_TTL seconds."""
+    now = time.monotonic()
+    if _LOCAL_IP_CACHE['value'] is None or now - _LOCAL_IP_CACHE['time'] > LOCAL_IP_TTL:
+        _LOCAL_IP_CACHE['value'] = _resolve_local_ip()
+        _LOCAL_IP_CACHE['time'] = now
+    return _LOCAL_IP_CACHE['value']
+
+
+def _resolve_local_ip():
     # Check for HOST_IP environment variable (used in Docker deployments)
     host_ip = os.environ.get('HOST_IP')
     if host_ip:
@@ -242,13 +1418,11 @@ def get_local_ip():
     
     try:
         # Create a socket to determine the local IP
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.settimeout(0)
-        # Connect to a public DNS (doesn't actually send data)
-        s.connect(('8.8.8.8', 80))
-        ip = s.getsockname()[0]
-        s.close()
-        return ip
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.settimeout(0)
+            # Connect to a public DNS (doesn't actually send data)
+            s.connect(('8.8.8.8', 80))
+            return s.getsockname()[0]
     except Exception:
         try:
             # Fallback: get hostname-based IP
@@ -264,6 +1438,12 @@ def get_local_ip():
             return '127.0.0.1'
 
 
+@lru_cache(maxsize=1)
+def get_hostname():
+    """Get the host name of the machine (resolved once per process)."""
+    return socket.gethostname()
+
+
 @app.route('/health')
 def health_check():
     """Health check endpoint for monitoring."""
@@ -289,7 +1469,7 @@ def get_connection_info():
         'ip': host_ip,
         'port': port,
         'url': f'http://{host_ip}:{port}',
-        'hostname': socket.gethostname()
+        'hostname': get_hostname()
     })
 
 
@@ -311,13 +1491,15 @@ def upload_file():
             'message': 'No files selected'
         }), 400
     
-    metadata = load_metadata()
     uploaded_files = []
     errors = []
+    now = datetime.now(timezone.utc)
+    upload_date = now.isoformat()
     
     for file in files:
         if file.filename == '':
             continue
+        staged = file.stream
         
         # Get relative path for nested folders
         file_path_str = file.filename
@@ -342,102 +1524,34 @@ def upload_file():
             })
             continue
         
-        # Generate unique file ID
-        file_id = str(uuid.uuid4())
-        
-        # Secure the filename
-        original_filename = filename
-        safe_filename = secure_filename(original_filename)
-        
-        # Handle duplicate filenames
-        existing_files = [f['filename'] for f in metadata['files'].values() 
-                          if f.get('folder_path') == folder_path]
-        
-        if safe_filename in existing_files:
-            name, ext = os.path.splitext(safe_filename)
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            safe_filename = f"{name}_{timestamp}{ext}"
-        
-        # Create folder structure if needed
-        folder_dir = os.path.join(UPLOAD_DIR, folder_path.replace('/', os.sep)) if folder_path != 'root' else UPLOAD_DIR
-        try:
-            Path(folder_dir).mkdir(parents=True, exist_ok=True)
-        except Exception as e:
-            errors.append({
-                'filename': filename,
-                'error': 'FOLDER_CREATE_ERROR',
-                'message': str(e)
-            })
-            continue
-        
-        # Save file
-        file_path = os.path.join(folder_dir, f"{file_id}_{safe_filename}")
-        try:
-            file.save(file_path)
-        except Exception as e:
-            errors.append({
-                'filename': filename,
-                'error': 'SAVE_ERROR',
-                'message': str(e)
-            })
-            continue
-        
-        # Get file info
-        try:
-            file_size = os.path.getsize(file_path)
-        except Exception as e:
-            os.remove(file_path)
-            errors.append({
-                'filename': filename,
-                'error': 'SIZE_CHECK_ERROR',
-                'message': str(e)
-            })
-            continue
-        
-        mime_type, _ = mimetypes.guess_type(safe_filename)
-        
-        # Check file size
-        if file_size > MAX_FILE_SIZE:
-            os.remove(file_path)
+        # Oversized parts were cut off while streaming
+        if staged.oversized:
             errors.append({
                 'filename': filename,
                 'error': 'FILE_TOO_LARGE',
-                'message': f'Exceeds {format_file_size(MAX_FILE_SIZE)}'
+                'message': f'Exceeds {MAX_FILE_SIZE_FORMATTED}'
             })
             continue
         
-        # Store metadata
-        file_metadata = {
-            'id': file_id,
-            'filename': safe_filename,
-            'original_filename': original_filename,
-            'size': file_size,
-            'size_formatted': format_file_size(file_size),
-            'type': mime_type or 'application/octet-stream',
-            'icon': get_file_icon(mime_type, safe_filename),
-            'upload_date': datetime.now(timezone.utc).isoformat(),
-            'folder_path': folder_path,
-            'file_path': file_path
-        }
+        # Generate unique file ID
+        file_id = generate_file_id()
         
-        metadata['files'][file_id] = file_metadata
+        # Secure the filename
+        original_filename = filename
+        safe_filename = secure_filename(original_filename)
         
-        # Add folder if new
-        if folder_path not in metadata['folders']:
-            metadata['folders'].append(folder_path)
+        with folder_lock(folder_path):
+            saved = _store_upload(staged, file_id, original_filename, safe_filename,
+                                  folder_path, now, upload_date)
+        if 'error' in saved:
+            errors.append(saved)
+            continue
         
-        uploaded_files.append({
-            'id': file_id,
-            'filename': safe_filename,
-            'size': file_size,
-            'size_formatted': format_file_size(file_size),
-            'type': mime_type,
-            'icon': file_metadata['icon'],
-            'upload_date': file_metadata['upload_date'],
-            'url': f'/api/v1/files/{file_id}/download'
-        })
+        uploaded_files.append(saved)
     
-    save_metadata(metadata)
+    if uploaded_files:
+        with _META_LOCK:
+            save_metadata(load_metadata())
     
     return jsonify({
         'uploaded': uploaded_files,
@@ -447,6 +1561,82 @@ def upload_file():
     }), 201 if uploaded_files else 400
 
 
+def _store_upload(staged, file_id, original_filename, safe_filename, folder_path, now, upload_date):
+    """Move a staged upload into its folder and record it.
+
+    Must be called with the folder's stripe lock held so that the duplicate
+    name check and the metadata insert happen atomically for that folder.
+    Returns the upload summary, or an error dict.
+    """
+    # Handle duplicate filenames (only a name clash pays for the renaming)
+    if name_taken(folder_path, safe_filename):
+        name, ext = os.path.splitext(safe_filename)
+        stem = f"{name}_{now.astimezone().strftime('%Y%m%d_%H%M%S')}"
+        safe_filename = f"{stem}{ext}"
+        counter = 1
+        while name_taken(folder_path, safe_filename):
+            safe_filename = f"{stem}_{counter}{ext}"
+            counter += 1
+    
+    # Create folder structure if needed
+    folder_dir = os.path.join(UPLOAD_DIR, folder_path.replace('/', os.sep)) if folder_path != 'root' else UPLOAD_DIR
+    try:
+        Path(folder_dir).mkdir(parents=True, exist_ok=True)
+    except Exception as e:
+        return {
+            'filename': original_filename,
+            'error': 'FOLDER_CREATE_ERROR',
+            'message': str(e)
+        }
+    
+    # Save file (parts parsed by UploadRequest only need to be moved)
+    file_path = os.path.join(folder_dir, f"{file_id}_{safe_filename}")
+    try:
+        staged.move_to(file_path)
+    except Exception as e:
+        return {
+            'filename': original_filename,
+            'error': 'SAVE_ERROR',
+            'message': str(e)
+        }
+    
+    file_size = staged.size
+    mime_type = guess_mime_type(safe_filename)
+    
+    # Store metadata
+    file_metadata = {
+        'id': file_id,
+        'filename': safe_filename,
+        'original_filename': original_filename,
+        'size': file_size,
+        'size_formatted': format_file_size(file_size),
+        'type': mime_type or 'application/octet-stream',
+        'icon': get_file_icon(mime_type, safe_filename),
+        'upload_date': upload_date,
+        'folder_path': folder_path,
+        'file_path': file_path
+    }
+    
+    with _META_LOCK:
+        metadata = load_metadata()
+        metadata['files'][file_id] = file_metadata
+        index_file(file_metadata)
+        
+        # Add folder if new
+        add_folder(metadata, folder_path)
+    
+    return {
+        'id': file_id,
+        'filename': safe_filename,
+        'size': file_size,
+        'size_formatted': format_file_size(file_size),
+        'type': mime_type,
+        'icon': file_metadata['icon'],
+        'upload_date': file_metadata['upload_date'],
+        'url': f'/api/v1/files/{file_id}/download'
+    }
+
+
 @app.route('/api/v1/files', methods=['GET'])
 def list_files():
     """List all files with optional filtering."""
@@ -455,51 +1645,66 @@ def list_files():
     order = request.args.get('order', 'desc')
     file_type = request.args.get('type', None)
     
-    metadata = load_metadata()
-    files = list(metadata.get('files', {}).values())
-    
-    # Filter by folder
-    files = [f for f in files if f.get('folder_path', 'root') == folder_path]
-    
-    # Filter by type
-    if file_type:
-        type_map = {
-            'images': ['image/png', 'image/jpeg', 'image/gif', 'image/webp'],
-            'documents': ['application/pdf', 'application/msword', 
-                         'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-                         'text/plain', 'text/markdown'],
-            'text': ['text/plain', 'text/markdown', 'application/json', 'text/csv'],
-            'videos': ['video/mp4', 'video/avi', 'video/mov', 'video/webm', 'video/mkv', 'video/quicktime'],
-            'media': ['audio/mpeg', 'audio/wav', 'video/mp4', 'video/avi']
-        }
-        allowed_types = type_map.get(file_type, [])
-        if allowed_types:
-            files = [f for f in files if f.get('type') in allowed_types]
+    offset, limit = page_args()
+    allowed_types = LIST_TYPE_FILTERS.get(file_type) if file_type else None
+    
+    # Only the folder's own files are visited; filter them by type
+    matches = get_files_in_folder(folder_path)
+    if allowed_types:
+        matches = [f for f in matches if f.get('type') in allowed_types]
     
     # Sort files
     if sort_by == 'name':
-        files.sort(key=lambda x: x.get('filename', '').lower(), reverse=(order == 'desc'))
-    elif sort_by == 'size':
-        files.sort(key=lambda x: x.get('size', 0), reverse=(order == 'desc'))
-    else:  # date
-        files.sort(key=lambda x: x.get('upload_date', ''), reverse=(order == 'desc'))
+        names_lc = _META_CACHE['names_lc']
+        sort_key = lambda x: names_lc.get(x.get('id'), '')
+    else:
+        sort_key = SORT_KEYS.get(sort_by, SORT_KEYS['date'])
+    files = sorted_page(matches, sort_key, order == 'desc', offset, limit)
     
     # Get subfolders
-    all_folders = metadata.get('folders', ['root'])
-    subfolders = []
-    for folder in all_folders:
-        if folder.startswith(folder_path + '/') if folder_path != 'root' else '/' not in folder:
-            if folder != folder_path:
-                subfolders.append(folder)
+    subfolders = list(_META_CACHE['folder_children'].get(folder_path, ()))
     
     return jsonify({
         'files': files,
-        'total': len(files),
+        'total': len(matches),
         'folders': subfolders,
         'current_folder': folder_path
     })
 
 
+def page_args():
+    """Read the optional offset/limit pagination query parameters."""
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = request.args.get('limit', None, type=int)
+    return offset, (max(limit, 0) if limit is not None else None)
+
+
+def sorted_page(items, key, reverse, offset, limit):
+    """Return one page of items in sorted order.
+
+    With a limit only the first offset + limit items are selected with a
+    heap (O(N log k)) instead of sorting everything.
+    """
+    if limit is None:
+        return sorted(items, key=key, reverse=reverse)[offset:]
+    pick = heapq.nlargest if reverse else heapq.nsmallest
+    return pick(offset + limit, items, key=key)[offset:]
+
+
+def error_body(error, message):
+    """Serialize a fixed error response body once, for reuse across requests."""
+    return dump_json({'error': error, 'message': message}, indent=False) + b'\n'
+
+
+JSON_HEADERS = {'Content-Type': 'application/json'}
+_FILE_MISSING = error_body('FILE_MISSING', 'File no longer exists on disk')
+
+
+def file_missing():
+    """Response for a file that is in the metadata but gone from disk."""
+    return _FILE_MISSING, 404, JSON_HEADERS
+
+
 @app.route('/api/v1/files/<file_id>/download', methods=['GET'])
 def download_file(file_id):
     """Download a specific file."""
@@ -514,18 +1719,19 @@ def download_file(file_id):
     file_info = metadata['files'][file_id]
     file_path = file_info['file_path']
     
-    if not os.path.exists(file_path):
-        return jsonify({
-            'error': 'FILE_MISSING',
-            'message': 'File no longer exists on disk'
-        }), 404
-    
-    return send_file(
-        file_path,
-        as_attachment=True,
-        download_name=file_info['filename'],
-        mimetype=file_info.get('type', 'application/octet-stream')
-    )
+    # Range/If-None-Match are answered without re-sending the body, and the
+    # body itself goes out through wsgi.file_wrapper (sendfile) or X-Sendfile.
+    # send_file's own stat doubles as the existence check.
+    try:
+        return send_file(
+            file_path,
+            as_attachment=True,
+            download_name=file_info['filename'],
+            mimetype=file_info.get('type', 'application/octet-stream'),
+            conditional=True
+        )
+    except FileNotFoundError:
+        return file_missing()
 
 
 @app.route('/api/v1/files/<file_id>/preview', methods=['GET'])
@@ -543,35 +1749,42 @@ def preview_file(file_id):
     file_path = file_info['file_path']
     mime_type = file_info.get('type', '')
     
-    if not os.path.exists(file_path):
-        return jsonify({
-            'error': 'FILE_MISSING',
-            'message': 'File no longer exists on disk'
-        }), 404
-    
-    # For images, serve directly
-    if mime_type.startswith('image/'):
-        return send_file(file_path, mimetype=mime_type)
-    
-    # For text files, return content
-    if mime_type.startswith('text/') or mime_type in ['application/json']:
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read(50000)  # Limit preview to 50KB
+    try:
+        # For images, serve directly
+        if mime_type.startswith('image/'):
+            return send_file(file_path, mimetype=mime_type, conditional=True,
+                             max_age=PREVIEW_MAX_AGE)
+        
+        # For text files, return content
+        if mime_type.startswith('text/') or mime_type == 'application/json':
+            with open(file_path, 'rb') as f:
+                raw = f.read(PREVIEW_LIMIT + 1)
+            truncated = len(raw) > PREVIEW_LIMIT
+            raw = raw[:PREVIEW_LIMIT]
+            # NUL bytes never appear in text; a character cut off at the limit is dropped
+            content = None
+            if b'\0' not in raw:
+                try:
+                    content = codecs.getincrementaldecoder('utf-8')().decode(raw, final=not truncated)
+                except UnicodeDecodeError:
+                    pass
+            if content is None:
                 return jsonify({
-                    'type': 'text',
-                    'content': content,
-                    'truncated': len(content) >= 50000
-                })
-        except UnicodeDecodeError:
+                    'error': 'BINARY_FILE',
+                    'message': 'Cannot preview binary file'
+                }), 400
             return jsonify({
-                'error': 'BINARY_FILE',
-                'message': 'Cannot preview binary file'
-            }), 400
-    
-    # For PDFs, serve for browser preview
-    if mime_type == 'application/pdf':
-        return send_file(file_path, mimetype=mime_type)
+                'type': 'text',
+                'content': content,
+                'truncated': truncated
+            })
+        
+        # For PDFs, serve for browser preview
+        if mime_type == 'application/pdf':
+            return send_file(file_path, mimetype=mime_type, conditional=True,
+                             max_age=PREVIEW_MAX_AGE)
+    except FileNotFoundError:
+        return file_missing()
     
     return jsonify({
         'error': 'UNSUPPORTED',
@@ -580,6 +1793,7 @@ def preview_file(file_id):
 
 
 @app.route('/api/v1/files/<file_id>', methods=['DELETE'])
+@locked_metadata
 def delete_file(file_id):
     """Delete a specific file (moves to trash for recovery)."""
     metadata = load_metadata()
@@ -593,21 +1807,20 @@ def delete_file(file_id):
     file_info = metadata['files'][file_id]
     file_path = file_info['file_path']
     
-    # Delete physical file
-    if os.path.exists(file_path):
-        try:
-            os.remove(file_path)
-        except Exception as e:
-            return jsonify({
-                'error': 'DELETE_ERROR',
-                'message': str(e)
-            }), 500
+    # Move the physical file aside so it can be restored
+    trash_path, error = stash_file(file_id, file_path)
+    if error:
+        return jsonify({
+            'error': 'DELETE_ERROR',
+            'message': error
+        }), 500
     
     # Move to trash for recovery
-    move_to_trash(file_id, file_info)
+    move_to_trash(file_id, file_info, trash_path)
     
     # Remove from metadata
     del metadata['files'][file_id]
+    unindex_file(file_info)
     save_metadata(metadata)
     
     return jsonify({
@@ -618,6 +1831,7 @@ def delete_file(file_id):
 
 
 @app.route('/api/v1/files/<file_id>/rename', methods=['PATCH'])
+@locked_metadata
 def rename_file(file_id):
     """Rename a file."""
     metadata = load_metadata()
@@ -644,12 +1858,17 @@ def rename_file(file_id):
     folder_dir = os.path.dirname(old_path)
     new_path = os.path.join(folder_dir, f"{file_id}_{new_name}")
     
-    if os.path.exists(old_path):
+    try:
         os.rename(old_path, new_path)
+    except FileNotFoundError:
+        pass
     
-    file_info['filename'] = new_name
-    file_info['file_path'] = new_path
-    file_info['icon'] = get_file_icon(file_info.get('type'), new_name)
+    unindex_file(file_info)
+    # Replace the record rather than edit it; a snapshot being encoded may share it
+    file_info = {**file_info, 'filename': new_name, 'file_path': new_path,
+                 'icon': get_file_icon(file_info.get('type'), new_name)}
+    metadata['files'][file_id] = file_info
+    index_file(file_info)
     
     save_metadata(metadata)
     
@@ -668,42 +1887,35 @@ def search_files():
             'message': 'Search query is required'
         }), 400
     
+    offset, limit = page_args()
     metadata = load_metadata()
-    files = list(metadata.get('files', {}).values())
-    
-    # Search by filename
-    results = []
-    for f in files:
-        filename = f.get('filename', '').lower()
-        if query in filename:
-            score = 1.0 if filename.startswith(query) else 0.5
-            f['relevance_score'] = score
-            results.append(f)
+    files = metadata.get('files', {})
     
     # Filter by type if specified
-    if file_type:
-        type_map = {
-            'images': ['image/'],
-            'documents': ['application/pdf', 'application/msword', 'text/'],
-            'text': ['text/'],
-            'videos': ['video/'],
-        }
-        prefixes = type_map.get(file_type, [])
-        if prefixes:
-            results = [f for f in results 
-                      if any(f.get('type', '').startswith(p) for p in prefixes)]
+    prefixes = SEARCH_TYPE_PREFIXES.get(file_type) if file_type else None
     
-    # Sort by relevance
-    results.sort(key=lambda x: x.get('relevance_score', 0), reverse=True)
+    # Search by filename through the n-gram index
+    matches = []
+    for file_id, filename in find_by_name(query):
+        f = files.get(file_id)
+        if f is None or (prefixes and not f.get('type', '').startswith(prefixes)):
+            continue
+        score = 1.0 if filename.startswith(query) else 0.5
+        matches.append((score, f))
+    
+    # Sort by relevance; only the returned page is copied
+    page = sorted_page(matches, itemgetter(0), True, offset, limit)
+    results = [{**f, 'relevance_score': score} for score, f in page]
     
     return jsonify({
         'results': results,
-        'total': len(results),
+        'total': len(matches),
         'query': query
     })
 
 
 @app.route('/api/v1/folders', methods=['POST'])
+@locked_metadata
 def create_folder():
     """Create a new folder."""
     data = request.get_json()
@@ -725,7 +1937,7 @@ def create_folder():
     
     metadata = load_metadata()
     
-    if full_path in metadata['folders']:
+    if folder_exists(full_path):
         return jsonify({
             'error': 'EXISTS',
             'message': 'Folder already exists'
@@ -735,7 +1947,7 @@ def create_folder():
     folder_dir = os.path.join(UPLOAD_DIR, full_path)
     Path(folder_dir).mkdir(parents=True, exist_ok=True)
     
-    metadata['folders'].append(full_path)
+    add_folder(metadata, full_path)
     save_metadata(metadata)
     
     return jsonify({
@@ -764,40 +1976,108 @@ def batch_download():
     
     metadata = load_metadata()
     
-    # Create ZIP in memory
-    memory_file = BytesIO()
-    with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-        total_size = 0
-        for file_id in file_ids:
-            if file_id in metadata.get('files', {}):
-                file_info = metadata['files'][file_id]
-                file_path = file_info['file_path']
-                
-                if os.path.exists(file_path):
-                    total_size += file_info.get('size', 0)
-                    
-                    # Check size limit (1GB)
-                    if total_size > 1024 * 1024 * 1024:
-                        return jsonify({
-                            'error': 'SIZE_LIMIT',
-                            'message': 'Total size exceeds 1GB limit'
-                        }), 400
-                    
-                    zf.write(file_path, file_info['filename'])
-    
-    memory_file.seek(0)
+    # Resolve files and check the size limit (1GB) before streaming starts,
+    # so the client can still get a JSON error.
+    # The cache key covers each file's path, name, size and mtime, so any
+    # change to the selection produces a fresh archive.
+    entries = []
+    total_size = 0
+    cache_key = hashlib.blake2b(digest_size=16)
+    for file_id in file_ids:
+        if file_id in metadata.get('files', {}):
+            file_info = metadata['files'][file_id]
+            file_path = file_info['file_path']
+            
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
+                continue
+            
+            total_size += file_info.get('size', 0)
+            
+            if total_size > 1024 * 1024 * 1024:
+                return jsonify({
+                    'error': 'SIZE_LIMIT',
+                    'message': 'Total size exceeds 1GB limit'
+                }), 400
+            
+            entries.append((file_path, file_info['filename'], file_info.get('type', '')))
+            cache_key.update(f"{file_path}\0{file_info['filename']}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
     
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    cache_path = os.path.join(ZIP_CACHE_DIR, f'{cache_key.hexdigest()}.zip')
+    cacheable = 0 < ZIP_CACHE_MAX_BYTES and total_size <= ZIP_CACHE_MAX_BYTES
     
-    return send_file(
-        memory_file,
+    if cacheable:
+        try:
+            mark_cache_hit(cache_path)
+            return send_file(
+                cache_path,
+                mimetype='application/zip',
+                as_attachment=True,
+                download_name=f'files_{timestamp}.zip',
+                conditional=True
+            )
+        except FileNotFoundError:
+            pass
+    
+    def build():
+        sink = ZipStreamSink()
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for file_path, arcname, mime_type in entries:
+                # A file deleted after the preflight is skipped rather than
+                # aborting an archive that is already half sent
+                try:
+                    zinfo = zip_entry_info(file_path, arcname, mime_type)
+                    src = open(file_path, 'rb')
+                except FileNotFoundError:
+                    continue
+                with src, zf.open(zinfo, 'w') as dest:
+                    while True:
+                        chunk = src.read(ZIP_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        dest.write(chunk)
+                        data = sink.drain()
+                        if data:
+                            yield data
+        data = sink.drain()
+        if data:
+            yield data
+    
+    def generate():
+        if not cacheable:
+            yield from build()
+            return
+        
+        # Keep a copy of the archive as it is sent; it only becomes visible
+        # to later requests once the whole stream has been written.
+        tmp_path = f'{cache_path}.{secrets.token_hex(4)}.tmp'
+        try:
+            with open(tmp_path, 'wb') as cache_file:
+                for data in build():
+                    cache_file.write(data)
+                    yield data
+        except BaseException:
+            remove_file(tmp_path)
+            raise
+        
+        # The archive has been sent in full; failing to keep it is not an error
+        try:
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            return
+        trim_cache_dir(ZIP_CACHE_DIR, ZIP_CACHE_MAX_BYTES)
+    
+    return Response(
+        stream_with_context(generate()),
         mimetype='application/zip',
-        as_attachment=True,
-        download_name=f'files_{timestamp}.zip'
+        headers={'Content-Disposition': f'attachment; filename=files_{timestamp}.zip'}
     )
 
 
 @app.route('/api/v1/batch/delete', methods=['POST'])
+@locked_metadata
 def batch_delete():
     """Delete multiple files at once (moves to trash for recovery)."""
     data = request.get_json()
@@ -813,26 +2093,31 @@ def batch_delete():
     deleted = []
     errors = []
     
+    targets = {}
     for file_id in file_ids:
-        if file_id in metadata.get('files', {}):
-            file_info = metadata['files'][file_id]
-            file_path = file_info['file_path']
-            
-            try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                
-                # Move to trash for recovery
-                move_to_trash(file_id, file_info)
-                
-                del metadata['files'][file_id]
-                deleted.append(file_id)
-            except Exception as e:
-                errors.append({'id': file_id, 'error': str(e)})
+        if file_id in metadata.get('files', {}) and file_id not in targets:
+            targets[file_id] = metadata['files'][file_id]
         else:
             errors.append({'id': file_id, 'error': 'Not found'})
     
-    save_metadata(metadata)
+    # Move the physical files aside in parallel, then update metadata in one pass
+    paths = [file_info['file_path'] for file_info in targets.values()]
+    stashed = _UNLINK_POOL.map(stash_file, targets.keys(), paths)
+    for (file_id, file_info), (trash_path, error) in zip(targets.items(), stashed):
+        if error:
+            errors.append({'id': file_id, 'error': error})
+            continue
+        
+        # Move to trash for recovery
+        move_to_trash(file_id, file_info, trash_path, save=False)
+        
+        del metadata['files'][file_id]
+        unindex_file(file_info)
+        deleted.append(file_id)
+    
+    if deleted:
+        save_trash(load_trash())
+        save_metadata(metadata)
     
     return jsonify({
         'deleted': deleted,
@@ -843,22 +2128,17 @@ def batch_delete():
 
 
 @app.route('/api/v1/files/<file_id>/restore', methods=['POST'])
+@locked_metadata
 def restore_file(file_id):
     """Restore a deleted file from trash."""
-    success = restore_from_trash(file_id)
+    error = restore_from_trash(file_id)
     
-    if not success:
-        trash = load_trash()
-        if file_id in trash.get('deleted_files', {}):
-            return jsonify({
-                'error': 'TRASH_EXPIRED',
-                'message': 'File recovery period expired (24 hours). File permanently deleted.'
-            }), 410
-        else:
-            return jsonify({
-                'error': 'NOT_IN_TRASH',
-                'message': 'File not found in trash'
-            }), 404
+    if error:
+        status, message = RESTORE_ERRORS[error]
+        return jsonify({
+            'error': error,
+            'message': message
+        }), status
     
     return jsonify({
         'id': file_id,
@@ -867,6 +2147,7 @@ def restore_file(file_id):
 
 
 @app.route('/api/v1/batch/restore', methods=['POST'])
+@locked_metadata
 def batch_restore():
     """Restore multiple deleted files from trash."""
     data = request.get_json()
@@ -882,23 +2163,15 @@ def batch_restore():
     errors = []
     
     for file_id in file_ids:
-        success = restore_from_trash(file_id)
-        if success:
-            restored.append(file_id)
+        error = restore_from_trash(file_id)
+        if error:
+            errors.append({
+                'id': file_id,
+                'error': error,
+                'message': RESTORE_ERRORS[error][1]
+            })
         else:
-            trash = load_trash()
-            if file_id in trash.get('deleted_files', {}):
-                errors.append({
-                    'id': file_id,
-                    'error': 'TRASH_EXPIRED',
-                    'message': 'Recovery period expired'
-                })
-            else:
-                errors.append({
-                    'id': file_id,
-                    'error': 'NOT_IN_TRASH',
-                    'message': 'File not found in trash'
-                })
+            restored.append(file_id)
     
     return jsonify({
         'restored': restored,
@@ -910,18 +2183,16 @@ def batch_restore():
 @app.route('/api/v1/trash', methods=['GET'])
 def get_trash():
     """Get list of deleted files in trash."""
-    trash = load_trash()
-    deleted_files = trash.get('deleted_files', {})
+    with _META_LOCK:
+        entries = list(load_trash().get('deleted_files', {}).items())
     
-    # Filter out expired entries and format response
+    # Skip expired entries (the background sweep removes them) and format response
     now = datetime.now(timezone.utc)
     files = []
-    expired_ids = []
     
-    for file_id, entry in deleted_files.items():
+    for file_id, entry in entries:
         expires_at = datetime.fromisoformat(entry['expires_at'])
         if now > expires_at:
-            expired_ids.append(file_id)
             continue
         
         file_info = entry['file_info']
@@ -936,14 +2207,8 @@ def get_trash():
             'expires_at': entry['expires_at']
         })
     
-    # Clean up expired entries
-    if expired_ids:
-        for file_id in expired_ids:
-            del deleted_files[file_id]
-        save_trash(trash)
-    
     # Sort by deletion time (newest first)
-    files.sort(key=lambda x: x['deleted_at'], reverse=True)
+    files.sort(key=itemgetter('deleted_at'), reverse=True)
     
     return jsonify({
         'files': files,
@@ -954,24 +2219,14 @@ def get_trash():
 @app.route('/api/v1/trash', methods=['DELETE'])
 def empty_trash():
     """Permanently delete all files in trash."""
-    trash = load_trash()
-    deleted_files = trash.get('deleted_files', {})
-    
-    # Delete physical files
-    deleted_count = 0
-    for file_id, entry in deleted_files.items():
-        file_info = entry.get('file_info', {})
-        file_path = file_info.get('file_path')
-        if file_path and os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-                deleted_count += 1
-            except Exception:
-                pass
+    # Clear trash, then delete the physical files without holding the lock
+    with _META_LOCK:
+        trash = load_trash()
+        paths = [entry.get('trash_path') for entry in trash.get('deleted_files', {}).values()]
+        trash['deleted_files'] = {}
+        save_trash(trash)
     
-    # Clear trash
-    trash['deleted_files'] = {}
-    save_trash(trash)
+    deleted_count = purge_files([path for path in paths if path])
     
     return jsonify({
         'message': f'Permanently deleted {deleted_count} file(s)',
@@ -980,6 +2235,7 @@ def empty_trash():
 
 
 @app.route('/api/v1/trash/<file_id>', methods=['DELETE'])
+@locked_metadata
 def permanently_delete_file(file_id):
     """Permanently delete a specific file from trash."""
     trash = load_trash()
@@ -990,19 +2246,15 @@ def permanently_delete_file(file_id):
             'message': 'File not found in trash'
         }), 404
     
-    entry = trash['deleted_files'][file_id]
-    file_info = entry.get('file_info', {})
-    file_path = file_info.get('file_path')
+    trash_path = trash['deleted_files'][file_id].get('trash_path')
     
     # Delete physical file
-    if file_path and os.path.exists(file_path):
-        try:
-            os.remove(file_path)
-        except Exception as e:
-            return jsonify({
-                'error': 'DELETE_FAILED',
-                'message': str(e)
-            }), 500
+    error = remove_file(trash_path) if trash_path else None
+    if error:
+        return jsonify({
+            'error': 'DELETE_FAILED',
+            'message': error
+        }), 500
     
     # Remove from trash
     del trash['deleted_files'][file_id]
@@ -1017,22 +2269,20 @@ def permanently_delete_file(file_id):
 @app.route('/api/v1/stats', methods=['GET'])
 def get_stats():
     """Get platform statistics."""
-    metadata = load_metadata()
-    files = list(metadata.get('files', {}).values())
-    
-    total_size = sum(f.get('size', 0) for f in files)
-    
-    # Count by type
-    type_counts = {}
-    for f in files:
-        icon = f.get('icon', 'file')
-        type_counts[icon] = type_counts.get(icon, 0) + 1
+    # Totals are maintained incrementally alongside the cached metadata;
+    # read them in one critical section so the counts agree with each other
+    with _META_LOCK:
+        metadata = load_metadata()
+        total_files = len(metadata.get('files', {}))
+        total_folders = len(metadata.get('folders', []))
+        total_size = _META_CACHE['total_size']
+        type_counts = dict(_META_CACHE['type_counts'])
     
     return jsonify({
-        'total_files': len(files),
+        'total_files': total_files,
         'total_size': total_size,
         'total_size_formatted': format_file_size(total_size),
-        'total_folders': len(metadata.get('folders', [])),
+        'total_folders': total_folders,
         'type_breakdown': type_counts,
         'disk_space': get_disk_usage()
     })
@@ -1049,7 +2299,8 @@ def get_settings():
 def update_settings():
     """Update application settings."""
     data = request.get_json()
-    settings = load_settings()
+    current = load_settings()
+    settings = dict(current)
     
     if 'upload_dir' in data:
         new_upload_dir = data['upload_dir']
@@ -1063,13 +2314,169 @@ def update_settings():
     if 'theme' in data and data['theme'] in ['dark', 'light']:
         settings['theme'] = data['theme']
     
-    save_settings(settings)
+    if data.get('jpeg_encoder') in ('fast', 'small'):
+        settings['jpeg_encoder'] = data['jpeg_encoder']
+    
+    # Re-saving unchanged settings is served from the cache without a write
+    if settings != current:
+        save_settings(settings)
     return jsonify(settings)
 
 
+def compress_png(file_path, quality, img):
+    """Losslessly recompress a PNG and return the new bytes.
+
+    oxipng optimizes the existing file directly when pyoxipng is installed.
+    Otherwise Pillow re-encodes it at a zlib level derived from quality,
+    without optimize=True, whose exhaustive search makes saving many times slower.
+    The image keeps its own mode: PNG stores every mode Pillow reads from a
+    PNG, and widening palette or greyscale images only makes the file bigger.
+    """
+    if OXIPNG_AVAILABLE:
+        with open(file_path, 'rb') as f:
+            return oxipng.optimize_from_memory(f.read(), level=2)
+    
+    output = BytesIO()
+    img.save(output, format='PNG', compress_level=int((100 - quality) / 10))
+    return output.getvalue()
+
+
+def encode_jpegli(file_path, quality):
+    """Re-encode an image with the cjpegli tool and return the JPEG bytes."""
+    fd, out_path = tempfile.mkstemp(suffix='.jpg')
+    os.close(fd)
+    try:
+        subprocess.run([CJPEGLI, file_path, out_path, '-q', str(quality)],
+                       check=True, capture_output=True, timeout=120)
+        with open(out_path, 'rb') as f:
+            return f.read()
+    finally:
+        os.remove(out_path)
+
+
+def compress_jpeg(file_path, quality, img, encoder='fast'):
+    """Re-encode a JPEG at the given quality and return the new bytes.
+
+    The 'fast' encoder uses libjpeg-turbo's SIMD codec when PyTurboJPEG is
+    installed. 'small' trades encode time for size: jpegli when cjpegli is on
+    the PATH, otherwise Pillow's optimized progressive output. Pillow handles
+    everything else, including colour spaces libjpeg-turbo can't convert.
+    """
+    if encoder == 'small':
+        if JPEGLI_AVAILABLE:
+            try:
+                return encode_jpegli(file_path, quality)
+            except (OSError, subprocess.SubprocessError):
+                pass
+    elif TURBOJPEG_AVAILABLE and img.mode in ('RGB', 'L'):
+        with open(file_path, 'rb') as f:
+            raw = f.read()
+        # Grayscale stays single-channel; colour 4:2:0 would only add chroma planes
+        if img.mode == 'L':
+            pixel_format, subsample = TJPF_GRAY, TJSAMP_GRAY
+        else:
+            pixel_format, subsample = TJPF_BGR, TJSAMP_420
+        try:
+            return _TURBOJPEG.encode(_TURBOJPEG.decode(raw, pixel_format=pixel_format),
+                                     quality=quality, pixel_format=pixel_format,
+                                     jpeg_subsample=subsample)
+        except OSError:
+            pass
+    
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGB')
+    output = BytesIO()
+    img.save(output, format='JPEG', quality=quality, optimize=True,
+             progressive=encoder == 'small')
+    return output.getvalue()
+
+
+def parse_quality(value):
+    """Parse a quality query parameter, clamped to 10-100."""
+    quality = int(value)
+    return 10 if quality < 10 else 100 if quality > 100 else quality
+
+
+def compress_image(file_path, mime_type, quality, encoder='fast'):
+    """Recompress an image and return the new bytes.
+
+    PNG, JPEG and GIF keep their format; anything else becomes a JPEG.
+    """
+    with Image.open(file_path) as img:
+        if mime_type == 'image/png':
+            return compress_png(file_path, quality, img)
+        if mime_type in ('image/jpeg', 'image/jpg'):
+            return compress_jpeg(file_path, quality, img, encoder)
+        
+        output = BytesIO()
+        if mime_type == 'image/gif':
+            img.save(output, format='GIF', optimize=True)
+        else:
+            if img.mode in ('RGBA', 'LA', 'P'):
+                img = img.convert('RGB')
+            img.save(output, format='JPEG', quality=quality, optimize=True)
+        return output.getvalue()
+
+
+def compress_pdf(file_path):
+    """Rewrite a PDF and return the new bytes.
+
+    With pikepdf, qpdf packs objects into compressed object streams, which
+    actually shrinks the file; PyPDF2 can only copy the pages across.
+    """
+    if PIKEPDF_AVAILABLE:
+        output = BytesIO()
+        with pikepdf.open(file_path) as pdf:
+            pdf.save(output, compress_streams=True,
+                     object_stream_mode=pikepdf.ObjectStreamMode.generate)
+        return output.getvalue()
+    
+    reader = PdfReader(file_path)
+    writer = PdfWriter()
+    
+    for page in reader.pages:
+        writer.add_page(page)
+    
+    output = BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+def compress_to_file(out_path, func, *args):
+    """Call a compression function and write its result to out_path; returns the size."""
+    data = func(*args)
+    with open(out_path, 'wb') as f:
+        f.write(data)
+    return len(data)
+
+
+def run_compression(func, *args):
+    """Run a compression function in the worker process pool and return its result."""
+    if COMPRESS_WORKERS <= 0:
+        return func(*args)
+    
+    with _COMPRESS_POOL_LOCK:
+        pool = _COMPRESS_POOL['pool']
+        if pool is None:
+            pool = _COMPRESS_POOL['pool'] = ProcessPoolExecutor(
+                max_workers=COMPRESS_WORKERS, mp_context=COMPRESS_MP_CONTEXT)
+    try:
+        return pool.submit(func, *args).result()
+    except BrokenProcessPool:
+        # A worker died (e.g. killed for memory); start a fresh pool next time
+        with _COMPRESS_POOL_LOCK:
+            if _COMPRESS_POOL['pool'] is pool:
+                _COMPRESS_POOL['pool'] = None
+        raise
+
+
 @app.route('/api/v1/files/<file_id>/download/compressed', methods=['GET'])
 def download_compressed_file(file_id):
-    """Download a file with optional compression."""
+    """Download a file with optional compression.
+
+    Results are kept in COMPRESS_CACHE_DIR, keyed by the file, its size and
+    mtime and the compression options, so repeat downloads skip the encode.
+    """
     metadata = load_metadata()
     
     if file_id not in metadata.get('files', {}):
@@ -1078,71 +2485,86 @@ def download_compressed_file(file_id):
     file_info = metadata['files'][file_id]
     file_path = file_info['file_path']
     
-    if not os.path.exists(file_path):
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
         return jsonify({'error': 'NOT_FOUND', 'message': 'File not found on disk'}), 404
     
-    quality = request.args.get('quality', 80, type=int)
-    quality = max(10, min(100, quality))
+    quality = request.args.get('quality', 80, type=parse_quality)
     
     mime_type = file_info.get('type', '')
     filename = file_info['filename']
     
+    if quality >= PASSTHROUGH_QUALITY.get(mime_type, 101):
+        return send_file(file_path, as_attachment=True, download_name=filename, conditional=True)
+    
+    encoder = ''
     if mime_type.startswith('image/') and PILLOW_AVAILABLE:
-        try:
-            img = Image.open(file_path)
-            output = BytesIO()
-            
-            if mime_type == 'image/png':
-                if img.mode in ('RGBA', 'LA', 'P'):
-                    img = img.convert('RGBA')
-                else:
-                    img = img.convert('RGB')
-                compress_level = int((100 - quality) / 10)
-                img.save(output, format='PNG', optimize=True, compress_level=compress_level)
-            elif mime_type in ('image/jpeg', 'image/jpg'):
-                if img.mode in ('RGBA', 'LA', 'P'):
-                    img = img.convert('RGB')
-                img.save(output, format='JPEG', quality=quality, optimize=True)
-            elif mime_type == 'image/gif':
-                img.save(output, format='GIF', optimize=True)
-            else:
-                if img.mode in ('RGBA', 'LA', 'P'):
-                    img = img.convert('RGB')
-                img.save(output, format='JPEG', quality=quality, optimize=True)
-                filename = os.path.splitext(filename)[0] + '.jpg'
-            
-            output.seek(0)
-            return send_file(
-                output,
-                mimetype=mime_type,
-                as_attachment=True,
-                download_name=filename
-            )
-        except Exception as e:
-            return send_file(file_path, as_attachment=True, download_name=filename)
+        out_type = mime_type
+        if mime_type in ('image/jpeg', 'image/jpg'):
+            encoder = load_settings()['jpeg_encoder']
+        elif mime_type not in ('image/png', 'image/gif'):
+            out_type = 'image/jpeg'
+            filename = os.path.splitext(filename)[0] + '.jpg'
+    elif mime_type == 'application/pdf' and PDF_COMPRESSION:
+        out_type = mime_type
+    else:
+        return send_file(file_path, as_attachment=True, download_name=filename, conditional=True)
+    
+    # PDF output doesn't depend on the quality, so every quality shares one entry
+    key_quality = '' if out_type == 'application/pdf' else quality
+    key = f'{file_id}\0{mime_type}\0{key_quality}\0{encoder}\0{stat.st_size}\0{stat.st_mtime_ns}'
+    cache_path = os.path.join(COMPRESS_CACHE_DIR, hashlib.blake2b(key.encode(), digest_size=16).hexdigest())
     
-    elif mime_type == 'application/pdf' and PYPDF2_AVAILABLE:
+    if COMPRESS_CACHE_MAX_BYTES > 0:
         try:
-            reader = PdfReader(file_path)
-            writer = PdfWriter()
-            
-            for page in reader.pages:
-                writer.add_page(page)
-            
-            output = BytesIO()
-            writer.write(output)
-            output.seek(0)
-            
+            mark_cache_hit(cache_path)
             return send_file(
-                output,
-                mimetype='application/pdf',
+                cache_path,
+                mimetype=out_type,
                 as_attachment=True,
-                download_name=filename
+                download_name=filename,
+                conditional=True
             )
-        except Exception as e:
-            return send_file(file_path, as_attachment=True, download_name=filename)
+        except FileNotFoundError:
+            pass
     
-    return send_file(file_path, as_attachment=True, download_name=filename)
+    # The worker writes the result straight to disk, so it is neither
+    # pickled back to this process nor held in memory while it is sent
+    tmp_path = f'{cache_path}.{secrets.token_hex(4)}.tmp'
+    try:
+        if out_type == 'application/pdf':
+            size = run_compression(compress_to_file, tmp_path, compress_pdf, file_path)
+        else:
+            size = run_compression(compress_to_file, tmp_path, compress_image,
+                                   file_path, mime_type, quality, encoder)
+    except Exception as e:
+        app.logger.warning("Compressing %s failed, sending the original: %s", file_id, e)
+        remove_file(tmp_path)
+        return send_file(file_path, as_attachment=True, download_name=file_info['filename'],
+                         conditional=True)
+    
+    if 0 < size <= COMPRESS_CACHE_MAX_BYTES:
+        os.replace(tmp_path, cache_path)
+        trim_cache_dir(COMPRESS_CACHE_DIR, COMPRESS_CACHE_MAX_BYTES)
+        return send_file(
+            cache_path,
+            mimetype=out_type,
+            as_attachment=True,
+            download_name=filename,
+            conditional=True
+        )
+    
+    # Too big to keep: unlink the temporary file once it is open. Where open
+    # files can't be removed, trim_cache_dir clears it out later.
+    output = open(tmp_path, 'rb')
+    remove_file(tmp_path)
+    return send_file(
+        output,
+        mimetype=out_type,
+        as_attachment=True,
+        download_name=filename
+    )
 
 
 @app.route('/api/v1/compression/support', methods=['GET'])
@@ -1150,41 +2572,104 @@ def get_compression_support():
     """Get information about supported compression formats."""
     return jsonify({
         'image_compression': PILLOW_AVAILABLE,
-        'pdf_compression': PYPDF2_AVAILABLE,
+        'pdf_compression': PDF_COMPRESSION,
+        'jpeg_encoder': 'libjpeg-turbo' if TURBOJPEG_AVAILABLE else 'pillow',
+        'jpeg_small_encoder': 'jpegli' if JPEGLI_AVAILABLE else 'pillow',
         'supported_formats': {
             'images': ['png', 'jpg', 'jpeg', 'gif'] if PILLOW_AVAILABLE else [],
-            'documents': ['pdf'] if PYPDF2_AVAILABLE else []
+            'documents': ['pdf'] if PDF_COMPRESSION else []
         }
     })
 
 
 # Error handlers
+# These bodies never change, so they are serialized once instead of per response
+_ERROR_413 = error_body('FILE_TOO_LARGE', f'File exceeds maximum size of {MAX_FILE_SIZE_FORMATTED}')
+_ERROR_404 = error_body('NOT_FOUND', 'Resource not found')
+_ERROR_500 = error_body('SERVER_ERROR', 'An internal error occurred')
+
+
 @app.errorhandler(413)
 def request_entity_too_large(error):
-    return jsonify({
-        'error': 'FILE_TOO_LARGE',
-        'message': f'File exceeds maximum size of {format_file_size(MAX_FILE_SIZE)}'
-    }), 413
+    return _ERROR_413, 413, JSON_HEADERS
 
 
 @app.errorhandler(404)
 def not_found(error):
-    return jsonify({
-        'error': 'NOT_FOUND',
-        'message': 'Resource not found'
-    }), 404
+    return _ERROR_404, 404, JSON_HEADERS
 
 
 @app.errorhandler(500)
 def internal_error(error):
-    return jsonify({
-        'error': 'SERVER_ERROR',
-        'message': 'An internal error occurred'
-    }), 500
+    return _ERROR_500, 500, JSON_HEADERS
+
+
+@app.before_request
+def start_on_first_request():
+    """Run start_serving() in the process that handles requests."""
+    if not _STARTUP['done']:
+        start_serving()
+
+
+@app.before_request
+def note_foreground_io():
+    """Count uploads and downloads in flight, for purge throttling."""
+    if request.endpoint in FOREGROUND_ENDPOINTS:
+        with _FOREGROUND_LOCK:
+            _FOREGROUND_IO['active'] += 1
+        request.environ['lanshare.foreground'] = True
+
+
+def track_foreground_io(wsgi_app):
+    """Keep a transfer counted until the server has finished sending its body.
+
+    Downloads are streamed after the view returns, so the count is only
+    dropped when the server closes the response iterable. File wrappers
+    keep their type, so servers can still hand them to sendfile().
+    """
+    def wrapper(environ, start_response):
+        try:
+            result = wsgi_app(environ, start_response)
+        except BaseException:
+            if environ.get('lanshare.foreground'):
+                _foreground_done()
+            raise
+        if not environ.get('lanshare.foreground'):
+            return result
+        
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None and isinstance(result, file_wrapper):
+            close = result.close
+            
+            def close_and_count():
+                try:
+                    close()
+                finally:
+                    _foreground_done()
+            
+            result.close = close_and_count
+            return result
+        return ClosingIterator(result, _foreground_done)
+    
+    return wrapper
+
+
+@app.after_request
+def x_accel_redirect(response):
+    """Rewrite X-Sendfile into nginx's X-Accel-Redirect when configured."""
+    file_path = response.headers.get('X-Sendfile') if X_ACCEL_PREFIX else None
+    if file_path:
+        upload_root = os.path.join(app.root_path, UPLOAD_DIR)
+        relative = os.path.relpath(file_path, upload_root).replace(os.sep, '/')
+        del response.headers['X-Sendfile']
+        response.headers['X-Accel-Redirect'] = f"{X_ACCEL_PREFIX.rstrip('/')}/{quote(relative)}"
+    return response
 
 
 # Configure app
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
+app.config['USE_X_SENDFILE'] = USE_X_SENDFILE or bool(X_ACCEL_PREFIX)
+app.wsgi_app = track_foreground_io(app.wsgi_app)
 
 
 if __name__ == '__main__':
@@ -1198,9 +2683,10 @@ if __name__ == '__main__':
 ╠══════════════════════════════════════════════════════════════╣
 ║  Server running at: http://{host}:{port:<24}      ║
 ║  Upload directory:  {UPLOAD_DIR:<38} ║
-║  Max file size:     {format_file_size(MAX_FILE_SIZE):<38} ║
+║  Max file size:     {MAX_FILE_SIZE_FORMATTED:<38} ║
 ╚══════════════════════════════════════════════════════════════╝
     """)
     
+    start_serving()
     app.run(host=host, port=port, debug=debug, threaded=True)
 
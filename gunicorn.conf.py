@@ -0,0 +1,28 @@
+"""
+LAN File-Sharing Platform - Gunicorn Configuration
+Production server settings, picked up automatically by `gunicorn app:app`.
+"""
+
+import os
+
+bind = f"{os.environ.get('SERVER_HOST', '0.0.0.0')}:{os.environ.get('SERVER_PORT', 8000)}"
+
+# File metadata is cached in-process, so run a single worker and serve
+# concurrent uploads/downloads from its thread pool. Disk I/O releases the
+# GIL, and downloads go through wsgi.file_wrapper (sendfile) under gunicorn.
+# CPU-bound image/PDF compression runs in a separate process pool
+# (COMPRESS_WORKERS), so it doesn't hold the GIL for the request threads
+# either. An ASGI server would still run this WSGI app on a thread pool, so
+# it would gain nothing over gthread.
+workers = 1
+worker_class = 'gthread'
+threads = int(os.environ.get('SERVER_THREADS', 32))
+
+# Large uploads over slow Wi-Fi can take a while
+timeout = 120
+
+# Keep idle connections open so browsers loading a folder of previews reuse
+# them instead of reconnecting for every request
+keepalive = int(os.environ.get('SERVER_KEEPALIVE', 75))
+
+accesslog = '-'